@@ -1,44 +1,59 @@
 import streamlit as st
-import requests
-import json
+import aiohttp
+import asyncio
+import io
+import orjson
 import time
+import threading
+import functools
+import hashlib
+import uuid
+from types import MappingProxyType
 import pandas as pd
+import pyarrow as pa
 from datetime import datetime
-from urllib.parse import quote_plus
 
+# Tabella dei tipi di ricerca, costruita una sola volta all'import.
+# I parametri sono in sola lettura per evitare modifiche accidentali.
+_SEARCH_TYPES_TABLE = {
+    "web": {
+        "params": MappingProxyType({}),
+        "results_key": "organic_results",
+        "export_fields": ["title", "link", "snippet", "displayed_link", "position"]
+    },
+    "images": {
+        "params": MappingProxyType({"tbm": "isch"}),
+        "results_key": "images_results", 
+        "export_fields": ["original"]
+    },
+    "news": {
+        "params": MappingProxyType({"tbm": "nws"}),
+        "results_key": "news_results",
+        "export_fields": ["title", "link", "snippet", "source", "date", "position"]
+    },
+    "videos": {
+        "params": MappingProxyType({"tbm": "vid"}),
+        "results_key": "video_results",
+        "export_fields": ["title", "link", "platform", "duration", "position"]
+    },
+    "shopping": {
+        "params": MappingProxyType({"tbm": "shop"}),
+        "results_key": "shopping_results",
+        "export_fields": ["title", "link", "price", "source", "rating", "reviews", "position"]
+    }
+}
+
+# Prefissi delle immagini non scaricabili (tupla, per un'unica chiamata a startswith)
+INVALID_IMAGE_PREFIXES = ("x-raw-image:///", "data:")
+
+@functools.lru_cache(maxsize=8)
 def get_search_type_params(search_type):
     """
     Restituisce i parametri base e i campi da estrarre per ogni tipo di ricerca
     """
-    search_types = {
-        "web": {
-            "params": {},
-            "results_key": "organic_results",
-            "export_fields": ["title", "link", "snippet", "displayed_link", "position"]
-        },
-        "images": {
-            "params": {"tbm": "isch"},
-            "results_key": "images_results", 
-            "export_fields": ["original"]
-        },
-        "news": {
-            "params": {"tbm": "nws"},
-            "results_key": "news_results",
-            "export_fields": ["title", "link", "snippet", "source", "date", "position"]
-        },
-        "videos": {
-            "params": {"tbm": "vid"},
-            "results_key": "video_results",
-            "export_fields": ["title", "link", "platform", "duration", "position"]
-        },
-        "shopping": {
-            "params": {"tbm": "shop"},
-            "results_key": "shopping_results",
-            "export_fields": ["title", "link", "price", "source", "rating", "reviews", "position"]
-        }
-    }
-    return search_types.get(search_type, search_types["web"])
+    return _SEARCH_TYPES_TABLE.get(search_type, _SEARCH_TYPES_TABLE["web"])
 
+@st.cache_data(max_entries=64, show_spinner=False)
 def build_query(base_query, domain=None, directory_include=None, directory_exclude=None, exclude_sites=None, 
                 exact_phrase=None, exclude_words=None, filetype=None, exclude_filetypes=None, date_after=None, date_before=None):
     """
@@ -97,6 +112,69 @@ def build_query(base_query, domain=None, directory_include=None, directory_exclu
     
     return ' '.join(query_parts)
 
+class RateLimiter:
+    """
+    Token bucket condiviso tra thread: al massimo `max_rate` richieste ogni `time_period` secondi
+    """
+    def __init__(self, max_rate=5, time_period=1.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Prenota un token e restituisce i secondi da attendere prima di usarlo
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self.max_rate / self.time_period
+            self._tokens = min(self.max_rate, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / rate)
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.reserve())
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+# Stati HTTP per cui una richiesta viene ritentata
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Attesa massima tra due tentativi, per non bloccare a lungo il thread di Streamlit
+MAX_RETRY_DELAY = 30.0
+
+def _retry_delay(retry_after, attempt, backoff_factor=0.5):
+    """
+    Calcola l'attesa prima di un nuovo tentativo, rispettando l'header Retry-After
+    se presente, senza mai superare MAX_RETRY_DELAY secondi
+    """
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = backoff_factor * (2 ** attempt)
+    return min(max(0.0, delay), MAX_RETRY_DELAY)
+
+def _has_next_page(results):
+    """
+    Indica se la risposta di SerpApi segnala una pagina successiva
+    """
+    return isinstance(results, dict) and "next" in results.get("serpapi_pagination", {})
+
+def _last_available_page(results, max_pages):
+    """
+    Stima dal campo `other_pages` quante pagine esistono, entro `max_pages`.
+    Restituisce None se la paginazione non lo indica.
+    """
+    other_pages = results.get("serpapi_pagination", {}).get("other_pages") or {}
+    page_numbers = [int(page) for page in other_pages if str(page).isdigit()]
+    if not page_numbers:
+        return None
+    return min(max_pages, max(page_numbers))
+
 class SerpApiClient:
     SEARCH_TYPES = {
         "web": "Web",
@@ -106,97 +184,263 @@ class SerpApiClient:
         "shopping": "Shopping"
     }
 
-    def __init__(self, api_key):
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, api_key, concurrency=4, max_rate=5):
         self.api_key = api_key
+        self.api_key_digest = hashlib.sha256(api_key.encode()).hexdigest()
         self.base_url = "https://serpapi.com/search"
-
-    def search(self, query, search_type="web", params=None):
-        """
-        Esegue una ricerca usando SerpApi
-        """
-        search_type_info = get_search_type_params(search_type)
-        default_params = {
+        self.concurrency = concurrency
+        self._base_params = {
             "engine": "google",
             "google_domain": "google.com",
             "gl": "it",
-            "hl": "it", 
+            "hl": "it",
             "num": 100,
-            "api_key": self.api_key,
-            "q": query
+            "api_key": api_key
         }
-        
-        # Aggiungi i parametri specifici del tipo di ricerca
-        default_params.update(search_type_info["params"])
+        self._limiter = RateLimiter(max_rate=max_rate, time_period=1.0)
+
+    def _build_params(self, query, search_type="web", params=None):
+        """
+        Costruisce i parametri della richiesta per il tipo di ricerca indicato
+        """
+        params_out = {**self._base_params, **get_search_type_params(search_type)["params"], "q": query}
         
         if params:
-            default_params.update(params)
-            
-        try:
-            response = requests.get(self.base_url, params=default_params)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            st.error(f"Errore nella richiesta: {str(e)}")
-            return None
+            params_out.update(params)
 
-    def get_results(self, query, search_type="web", max_pages=10, params=None):
+        return params_out
+
+    def _create_session(self):
         """
-        Recupera tutti i risultati disponibili con paginazione
+        Crea la sessione aiohttp: le connessioni vengono riusate tra le pagine di una ricerca
+        """
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=60)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def _search_async(self, session, semaphore, request_params, page_params):
+        """
+        Esegue una singola ricerca asincrona usando la sessione aiohttp condivisa.
+        In caso di risposta 429 o 5xx riprova fino a MAX_ATTEMPTS volte con backoff esponenziale.
+        """
+        request_params = {**request_params, **page_params}
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            async with semaphore:
+                async with self._limiter:
+                    async with session.get(self.base_url, params=request_params) as response:
+                        if response.status not in RETRY_STATUSES or attempt == self.MAX_ATTEMPTS - 1:
+                            response.raise_for_status()
+                            return await response.json()
+                        delay = _retry_delay(response.headers.get("Retry-After"), attempt)
+
+            # Attende fuori dal semaforo per non bloccare le altre pagine
+            await asyncio.sleep(delay)
+
+    async def _get_results_async(self, query, search_type="web", max_pages=10, params=None):
+        """
+        Scarica le pagine richieste restituendole in ordine. La prima pagina viene
+        scaricata da sola: le successive partono solo se la paginazione ne indica altre,
+        così le pagine inesistenti non consumano crediti SerpApi.
+        """
+        # I parametri comuni sono costruiti una volta sola, per pagina cambia solo "start"
+        request_params = self._build_params(query, search_type, params)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._create_session() as session:
+
+            async def fetch_page(page):
+                try:
+                    return await self._search_async(session, semaphore, request_params, {"start": page * 100})
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    return e
+
+            pages = [await fetch_page(0)]
+            if max_pages == 1 or not _has_next_page(pages[0]):
+                return pages
+
+            # Le pagine indicate da `other_pages` vengono scaricate in parallelo
+            last_page = _last_available_page(pages[0], max_pages)
+            if last_page:
+                pages.extend(await asyncio.gather(*[fetch_page(page) for page in range(1, last_page)]))
+                if not all(_has_next_page(page) for page in pages):
+                    return pages
+
+            # `other_pages` può sottostimare: si prosegue una pagina alla volta
+            # finché la paginazione ne segnala altre
+            while len(pages) < max_pages and _has_next_page(pages[-1]):
+                pages.append(await fetch_page(len(pages)))
+            return pages
+
+    def _collect_results(self, query, search_type="web", max_pages=10, params=None):
+        """
+        Scarica le pagine e ne estrae i risultati, fermandosi alla prima pagina vuota
+        o in errore. Restituisce i risultati, il numero totale di risultati grezzi
+        ricevuti e l'eventuale messaggio di errore.
         """
         all_results = []
-        current_page = 0
-        search_type_info = get_search_type_params(search_type)
-        results_key = search_type_info["results_key"]
+        raw_count = 0
+        error = None
+        results_key = get_search_type_params(search_type)["results_key"]
+
+        pages = asyncio.run(self._get_results_async(query, search_type, max_pages, params))
         
-        with st.spinner(f"Recupero risultati {self.SEARCH_TYPES[search_type]}..."):
-            progress_bar = st.progress(0)
+        # Le pagine arrivano in parallelo ma vengono elaborate in ordine
+        for results in pages:
+            if isinstance(results, Exception):
+                error = str(results)
+                break
             
-            while current_page < max_pages:
-                progress_bar.progress(current_page / max_pages)
+            if not results or "error" in results:
+                break
                 
-                page_params = params.copy() if params else {}
-                page_params["start"] = current_page * 100
-                
-                results = self.search(query, search_type, page_params)
-                
-                if not results or "error" in results:
-                    break
-                    
-                results_list = results.get(results_key, [])
-                
-                # Filtra i risultati per le immagini
-                if search_type == "images":
-                    results_list = [
-                        result for result in results_list 
-                        if result.get('original') 
-                        and result['original'].strip() != ""
-                        and not result['original'].startswith('x-raw-image:///')
-                    ]
-                
-                if not results_list:
-                    break
-                    
+            results_list = results.get(results_key, [])
+            raw_count += len(results_list)
+            previous_count = len(all_results)
+            
+            # Filtra i risultati per le immagini
+            if search_type == "images":
+                all_results.extend(
+                    result for result in results_list
+                    if (original := result.get('original'))
+                    and original.strip()
+                    and not original.startswith(INVALID_IMAGE_PREFIXES)
+                )
+            else:
                 all_results.extend(results_list)
-                
-                if "serpapi_pagination" not in results or "next" not in results["serpapi_pagination"]:
-                    break
-                    
-                current_page += 1
-                time.sleep(1)  # Rate limiting
             
-            progress_bar.progress(1.0)
+            if len(all_results) == previous_count:
+                break
+            
+            if not _has_next_page(results):
+                break
+
+        return all_results, raw_count, error
+
+    def get_results(self, query, search_type="web", max_pages=10, params=None):
+        """
+        Recupera tutti i risultati disponibili con paginazione
+        """
+        with st.spinner(f"Recupero risultati {self.SEARCH_TYPES[search_type]}..."):
+            try:
+                all_results, raw_count = _cached_results(
+                    self, self.api_key_digest, query, search_type, max_pages, _params_key(params)
+                )
+            except PartialResultsError as e:
+                # Mostra l'errore ma conserva le pagine scaricate prima del problema
+                st.error(f"Errore nella richiesta: {e.error}")
+                all_results, raw_count = e.results, e.raw_count
             
             # Mostra info sui risultati filtrati per le immagini
-            if search_type == "images":
-                total_results = len(results.get(results_key, []))
-                filtered_results = len(all_results)
-                if total_results != filtered_results:
-                    st.info(f"Filtrati {total_results - filtered_results} risultati non validi o vuoti")
+            if search_type == "images" and raw_count != len(all_results):
+                st.info(f"Filtrati {raw_count - len(all_results)} risultati non validi o vuoti")
                 
         return all_results
 
+def _params_key(params):
+    """
+    Converte i parametri in una tupla ordinata, utilizzabile come chiave di cache
+    """
+    return tuple(sorted((params or {}).items()))
+
+class PartialResultsError(Exception):
+    """
+    Ricerca interrotta da un errore: trasporta le pagine scaricate prima del problema.
+    Essendo un'eccezione, il risultato parziale non viene salvato nella cache.
+    """
+    def __init__(self, results, raw_count, error):
+        super().__init__(error)
+        self.results = results
+        self.raw_count = raw_count
+        self.error = error
+
+# La funzione in cache riceve il client come `_client`: Streamlit esclude
+# dall'hash gli argomenti con underscore, quindi la chiave API in chiaro non finisce
+# nella chiave di cache. Al suo posto viene usato il suo digest SHA-256.
+# Ogni voce contiene fino a max_pages pagine di risultati grezzi, quindi la cache è limitata.
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def _cached_results(_client, api_key_digest, query, search_type, max_pages, params_key):
+    results, raw_count, error = _client._collect_results(query, search_type, max_pages, dict(params_key))
+    if error:
+        raise PartialResultsError(results, raw_count, error)
+    return results, raw_count
+
+# Gli helper di esportazione ricevono il DataFrame come `_export_df`, escluso dall'hash:
+# la chiave di cache è il token univoco della ricerca, così i rerun non rileggono tutti
+# i risultati. Le cache sono limitate per non accumulare esportazioni tra le sessioni.
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _results_to_json_bytes(search_id, _export_df, search_timestamp, query, search_type, max_pages, params_tuple):
+    """
+    Serializza i risultati in JSON con i metadati della ricerca
+    """
+    json_data = {
+        "query": query,
+        "search_type": search_type,
+        "timestamp": search_timestamp,
+        "total_results": len(_export_df),
+        "pages_retrieved": max_pages,
+        "parameters": dict(params_tuple),
+        "results": _export_df.to_dict(orient="records")
+    }
+    
+    return orjson.dumps(
+        json_data,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    )
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _results_to_csv_bytes(search_id, _export_df):
+    """
+    Serializza in CSV i soli campi da esportare
+    """
+    buffer = io.BytesIO()
+    _export_df.to_csv(buffer, index=False, encoding="utf-8")
+    return buffer.getvalue()
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _results_to_parquet_bytes(search_id, _export_df):
+    """
+    Serializza in Parquet (Arrow, compressione zstd) i soli campi da esportare.
+    Restituisce None se le colonne hanno tipi misti non convertibili in Arrow.
+    """
+    buffer = io.BytesIO()
+    try:
+        _export_df.to_parquet(buffer, engine="pyarrow", compression="zstd", index=False)
+    except pa.ArrowException:
+        return None
+    return buffer.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def get_api_client(api_key):
+    """
+    Restituisce un client condiviso tra i rerun e le sessioni. Viene condiviso solo il
+    rate limiter: ogni ricerca apre comunque una nuova sessione aiohttp.
+    """
+    return SerpApiClient(api_key)
+
+def get_secrets_api_key():
+    """
+    Legge la chiave API dai secrets di Streamlit, se configurata.
+    Streamlit mette già in cache il file dei secrets e lo ricarica quando cambia.
+    """
+    try:
+        return st.secrets["serp_api"]["api_key"]
+    except Exception:
+        return None
+
+APP_TITLE = "🔍 Google Search Extractor"
+
+FOOTER_HTML = """
+---
+<div style='text-align: center'>
+    <p>Sviluppato con ❤️ usando Streamlit</p>
+</div>
+"""
+
 def create_serp_interface():
-    st.title("🔍 Google Search Extractor")
+    st.title(APP_TITLE)
     
     # Configurazione nella sidebar
     with st.sidebar:
@@ -206,10 +450,11 @@ def create_serp_interface():
         
         api_key = None
         if use_secrets:
-            try:
-                api_key = st.secrets["serp_api"]["api_key"]
+            secrets_api_key = get_secrets_api_key()
+            if secrets_api_key:
+                api_key = secrets_api_key
                 st.success("✅ Credenziali caricate dai secrets")
-            except Exception:
+            else:
                 st.error("❌ Errore nel caricamento dei secrets")
                 use_secrets = False
                 
@@ -330,7 +575,7 @@ def create_serp_interface():
             exact_phrase=exact_phrase,
             exclude_words=exclude_words,
             filetype=filetype,
-            exclude_filetypes=exclude_filetypes,
+            exclude_filetypes=tuple(exclude_filetypes),
             date_after=date_after.strftime("%Y-%m-%d") if date_after else None,
             date_before=date_before.strftime("%Y-%m-%d") if date_before else None
         )
@@ -349,28 +594,37 @@ def create_serp_interface():
                 st.error("⚠️ Inserisci una chiave API!")
                 return
                 
-            # Inizializza il client
-            client = SerpApiClient(api_key)
+            # Recupera il client condiviso
+            client = get_api_client(api_key)
             
             # Esegui la ricerca
             try:
                 results = client.get_results(query, search_type, max_pages, params)
                 
                 if results:
-                    st.session_state['search_results'] = results
+                    # Salva i risultati per colonne, limitati ai campi da esportare
+                    export_fields = get_search_type_params(search_type)["export_fields"]
+                    st.session_state['search_results_soa'] = {
+                        field: [result.get(field) for result in results]
+                        for field in export_fields
+                    }
+                    st.session_state['n_results'] = len(results)
                     st.session_state['search_type'] = search_type
-                    st.session_state['export_fields'] = get_search_type_params(search_type)["export_fields"]
+                    st.session_state['search_timestamp'] = datetime.now().isoformat()
+                    st.session_state['search_id'] = uuid.uuid4().hex
             except Exception as e:
                 st.error(f"❌ Errore durante la ricerca: {str(e)}")
                 return
 
     # Mostra risultati se presenti in session state
-    if 'search_results' in st.session_state:
-        results = st.session_state['search_results']
+    if 'search_results_soa' in st.session_state:
+        n_results = st.session_state['n_results']
         search_type = st.session_state['search_type']
-        export_fields = st.session_state['export_fields']
+        search_id = st.session_state['search_id']
         
-        df = pd.DataFrame(results)
+        # I risultati sono già per colonne: nessuna proiezione per riga,
+        # pandas converte solo ogni lista nel relativo array di colonna
+        export_df = pd.DataFrame(st.session_state['search_results_soa'], copy=False)
         
         # Visualizzazione risultati
         st.subheader("📊 Risultati della ricerca")
@@ -378,62 +632,62 @@ def create_serp_interface():
         # Metriche
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("Totale risultati", len(results))
+            st.metric("Totale risultati", n_results)
         with col2:
             st.metric("Pagine recuperate", max_pages)
         
         # Visualizza risultati in tabella
-        if all(field in df.columns for field in export_fields):
-            export_df = df[export_fields].copy()
-            st.dataframe(export_df, use_container_width=True)
-            
-            # Download buttons
-            st.subheader("📥 Esporta risultati")
-            col1, col2 = st.columns(2)
-            
-            # JSON con metadati completi
-            with col1:
-                json_data = {
-                    "query": query,
-                    "search_type": search_type,
-                    "timestamp": datetime.now().isoformat(),
-                    "total_results": len(results),
-                    "pages_retrieved": max_pages,
-                    "parameters": params,
-                    "results": json.loads(df.to_json(orient="records"))
-                }
-                
-                json_str = json.dumps(json_data, indent=2, ensure_ascii=False)
-                
-                st.download_button(
-                    label="📥 Scarica JSON",
-                    data=json_str.encode('utf-8'),
-                    file_name=f"search_results_{search_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                    mime="application/json"
-                )
-            
-            with col2:
-                csv_buffer = df[export_fields].to_csv(index=False)
-                st.download_button(
-                    label="📥 Scarica CSV",
-                    data=csv_buffer,
-                    file_name=f"search_results_{search_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                    mime="text/csv"
-                )
-        else:
+        if export_df.empty or export_df.isna().all(axis=None):
             st.error("❌ I risultati non contengono i campi attesi")
             return
 
+        st.dataframe(export_df, use_container_width=True)
+        
+        # Download buttons
+        st.subheader("📥 Esporta risultati")
+        col1, col2, col3 = st.columns(3)
+        
+        # JSON con i metadati della ricerca
+        with col1:
+            json_bytes = _results_to_json_bytes(
+                search_id,
+                export_df,
+                st.session_state['search_timestamp'],
+                query,
+                search_type,
+                max_pages,
+                _params_key(params)
+            )
+            
+            st.download_button(
+                label="📥 Scarica JSON",
+                data=json_bytes,
+                file_name=f"search_results_{search_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                mime="application/json"
+            )
+        
+        with col2:
+            csv_bytes = _results_to_csv_bytes(search_id, export_df)
+            st.download_button(
+                label="📥 Scarica CSV",
+                data=csv_bytes,
+                file_name=f"search_results_{search_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime="text/csv"
+            )
+        
+        with col3:
+            parquet_bytes = _results_to_parquet_bytes(search_id, export_df)
+            st.download_button(
+                label="📥 Scarica Parquet",
+                data=parquet_bytes or b"",
+                file_name=f"search_results_{search_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.parquet",
+                mime="application/vnd.apache.parquet",
+                disabled=parquet_bytes is None,
+                help="Non disponibile: i risultati contengono campi con tipi misti" if parquet_bytes is None else None
+            )
+
     # Footer
-    st.markdown("---")
-    st.markdown(
-        """
-        <div style='text-align: center'>
-            <p>Sviluppato con ❤️ usando Streamlit</p>
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
+    st.markdown(FOOTER_HTML, unsafe_allow_html=True)
 
 if __name__ == "__main__":
     # Configurazione della pagina Streamlit